@@ -12,18 +12,69 @@
 # !================================================================================================!
 """
 
-import sys, os, tempfile
-import argparse as ap, subprocess as sp
-from colorama import Fore
+import sys, os, hashlib, re, shutil
+import argparse as ap, functools, subprocess as sp
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Final, NoReturn
 
-class DefaultValue:
-	THREADS: int = 4
-	BUILD: str = './build'
+class PlainFore:
+	"""Colorless stand-in for `colorama.Fore`, used when not writing to a terminal.
+	"""
+	GREEN = YELLOW = RESET = ''
+
+class LazyFore:
+	"""Proxy for `colorama.Fore`, importing `colorama` on first attribute access only.
+	Colors are only useful on a terminal, `PlainFore` is used otherwise or if
+	`colorama` is not installed. The global `Fore` is then rebound, so later
+	lookups skip the proxy.
+	"""
+	def __getattr__(self, name: str) -> str:
+		global Fore
+		Fore = PlainFore
+		if sys.stdout.isatty():
+			try:
+				from colorama import Fore
+			except ImportError:
+				pass
+		return getattr(Fore, name)
+
+Fore = LazyFore()
+
+# `sched_getaffinity` respects CPU affinity masks (taskset, containers)
+DEFAULT_THREADS: Final[int] = (
+	len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 4)
+)
+DEFAULT_BUILD: Final[str] = './build'
+
+COMPILATION_DATABASE: Final[str] = 'compile_commands.json'
+# Working directory of `compdb` inside the build directory, holding CMake's database,
+# the `compdb` output of the last upgrade and the digests it was created from
+COMPDB_DIRECTORY: Final[str] = '.compdb'
+COMPILATION_DATABASE_CACHE: Final[str] = os.path.join(COMPDB_DIRECTORY, 'upgraded.json')
+COMPILATION_DATABASE_STAMP: Final[str] = os.path.join(COMPDB_DIRECTORY, 'stamp')
+
+CMAKE_BUILD_COMMAND: Final[list[str]] = ['cmake', '--build', './']
+
+BUILD_DIRECTORY_PATTERN: Final[re.Pattern[str]] = re.compile(r'[A-Za-z0-9_./\-]{1,200}')
 
+# Option help text templates, colored like the Bash version: commands in yellow, paths
+# in green. They used to be precomputed colored strings; colors and values are now filled
+# in by `format_help` when help is printed, so `colorama` is not imported at startup.
+HELP_BUILD: Final[str] = 'Choose a different build directory. Default: \'{Fore.GREEN}{default}{Fore.RESET}\''
+HELP_COMPILE: Final[str] = 'Compile the project by calling {Fore.YELLOW}cmake --build{Fore.RESET}'
+HELP_THREADS: Final[str] = '''
+	Specify the number of threads to compile with when the '-c' flag
+	is specified. Default: {Fore.YELLOW}CMAKE_BUILD_PARALLEL_LEVEL{Fore.RESET} if set, otherwise {default}
+'''
+HELP_NOT_UPDATE_CLANGD_DB: Final[str] = 'Disable use of {Fore.YELLOW}compdb{Fore.RESET} to upgrade the clangd database. Default: False'
+HELP_REFRESH_CLANGD_DB: Final[str] = '''
+	Run {Fore.YELLOW}compdb{Fore.RESET} even if the clangd database looks up to date, e.g. after
+	changing headers outside the project directory. Default: False
+'''
 
 def main() -> int:
 	# Getting cli arguments/options and parsing them
-	args: ap.Namespace = create_option_parser().parse_args()
+	args: ap.Namespace = create_option_parser(help_requested(sys.argv[1:])).parse_args()
 	
 	# Ensuring the required tools exist before further processing
 	res: None | str = find_required_tools(args)
@@ -36,30 +87,55 @@ def main() -> int:
 	except sp.CalledProcessError:
 		return 1
 	
-	if not args.not_update_clangd_db:
+	# Printed before building, so it is shown the same way on every path below
+	print('\nBuild files location:')
+	print(f'>>> {Fore.GREEN}{os.getcwd()}{Fore.RESET}')
+	
+	updateDatabase: bool = not args.not_update_clangd_db
+	
+	if updateDatabase:
 		try:
-			compile_database()
+			if args.compile:
+				compile_cmake_project_with_database(args.threads, args.refresh_clangd_db)
+			else:
+				compile_database(args.refresh_clangd_db)
 		except (OSError, sp.CalledProcessError):
 			return 1
 	
-	if args.compile:
+	if args.compile and not updateDatabase:
+		# Replaces this process with `cmake` on success
 		try:
 			compile_cmake_project(args.threads)
-		except (OSError, sp.CalledProcessError):
+		except OSError:
 			return 1
 	
-	print('\nBuild files location:')
-	print(f'>>> {Fore.GREEN}{os.getcwd()}')
 	return 0
 
 
-def create_option_parser() -> ap.ArgumentParser:
+def help_requested(argv: list[str]) -> bool:
+	"""Check if `argv` may make argparse print the help text.
+	Also matches abbreviated long options and bundled short options.
+	"""
+	for arg in argv:
+		if arg.startswith('--h'):
+			return True
+		if arg.startswith('-') and not arg.startswith('--') and 'h' in arg:
+			return True
+	return False
+
+def create_option_parser(withHelpText: bool = True) -> ap.ArgumentParser:
 	""" Process cli arguments using the argparse library
 
-	Adding options to `argparse` and returning an `ArgumentParser`
+	Adding options to `argparse` and returning an `ArgumentParser`.
+	The program description and epilog are only built if `withHelpText` is set.
 	"""
 	SCRIPT_NAME: str = sys.argv[0]
 
+	if not withHelpText:
+		parser: ap.ArgumentParser = ap.ArgumentParser(prog=SCRIPT_NAME, add_help=True)
+		add_options(parser, False)
+		return parser
+
 	PROGRAM_DESCRIPTION: str = '''
 		Python script to simplify CMake usage for C++ project construction.
 		The script stores the CMake files into a build directory and exports
@@ -80,37 +156,47 @@ def create_option_parser() -> ap.ArgumentParser:
 		add_help=True,
 		formatter_class=lambda prog: ap.HelpFormatter(prog, 8, 16)
 	)
+	add_options(parser)
+	return parser
 
+def add_options(parser: ap.ArgumentParser, withHelpText: bool = True) -> None:
+	"""Add the supported options to `parser`.
+	Help texts are only attached if `withHelpText` is set.
+	"""
 	#parser.add_argument('-v', '--version', action='version', version='%(prog)s 1.0.0')
 
 	parser.add_argument('-b', '--build',
-		type=str,
-		default=DefaultValue.BUILD,
+		type=build_directory,
+		default=DEFAULT_BUILD,
 		required=False,
-		help=f'Choose a different build directory. Default: \'{DefaultValue.BUILD}\'',
+		help=format_help(HELP_BUILD, withHelpText, default=DEFAULT_BUILD),
 	)
 
 	parser.add_argument('-c', '--compile',
 		required=False,
 		action='store_true',
-		help='Compile the project by calling CMake --build --parallel 4'
+		help=format_help(HELP_COMPILE, withHelpText)
 	)
 
 	parser.add_argument('-t', '--threads',
-		type=int,
-		default=DefaultValue.THREADS,
+		type=thread_count,
+		default=None,
 		required=False,
-		help=f'''
-			Specify the number of threads to compile with when the '-c' flag
-			is specified. Default: {DefaultValue.THREADS}
-		'''
+		help=format_help(HELP_THREADS, withHelpText, default=DEFAULT_THREADS)
 	)
 
 	parser.add_argument('--not_update_clangd_db',
-		action='store_false',
+		action='store_true',
+		default=False,
+		required=False,
+		help=format_help(HELP_NOT_UPDATE_CLANGD_DB, withHelpText)
+	)
+
+	parser.add_argument('--refresh_clangd_db',
+		action='store_true',
 		default=False,
 		required=False,
-		help='Disable use of `compdb` to upgrade the clangd database. Default: False'
+		help=format_help(HELP_REFRESH_CLANGD_DB, withHelpText)
 	)
 
 	parser.add_argument('--build_type',
@@ -121,31 +207,72 @@ def create_option_parser() -> ap.ArgumentParser:
 		help='Compile project with <debug|release> flag, Default: debug'
 	)
 
-	return parser
+def format_help(template: str, withHelpText: bool, **values: object) -> None | str:
+	"""Fill in the colors and the named `values` of a help text template,
+	or return `None` if `withHelpText` is not set.
+	"""
+	if not withHelpText:
+		return None
+	return template.format(Fore=Fore, **values)
 
-def terminal_program_exist(programName: str) -> bool:
+def thread_count(value: str) -> int:
+	"""Validate a thread count given on the command line, which must be a positive integer.
+	"""
 	try:
-		sp.check_output(f'command -v {programName}', shell=True)
-	except sp.CalledProcessError:
-		return False
-	return True
+		count: int = int(value)
+	except ValueError:
+		count = 0
+	if count < 1:
+		raise ap.ArgumentTypeError(f'thread count must be a positive integer: \'{value}\'')
+	return count
+
+def build_directory(value: str) -> str:
+	"""Validate a build directory given on the command line.
+	Only relative paths made of plain path characters are accepted. `..` segments,
+	both as given and after normalization, and the project directory itself are rejected.
+	"""
+	if BUILD_DIRECTORY_PATTERN.fullmatch(value) is None:
+		raise ap.ArgumentTypeError(f'invalid build directory: \'{value}\'')
+	if os.path.isabs(value):
+		raise ap.ArgumentTypeError(f'build directory must be a relative path: \'{value}\'')
+	if '..' in value.split('/') or '..' in os.path.normpath(value).split(os.sep):
+		raise ap.ArgumentTypeError(f'build directory may not contain \'..\': \'{value}\'')
+	if os.path.normpath(value) == os.curdir:
+		raise ap.ArgumentTypeError(f'build directory may not be the project directory: \'{value}\'')
+	return value
+
+def run_cmd(args: list[str], **kwargs) -> None:
+	"""Run a command given as an argument list, without an intermediate shell.
+	Throws `subprocess.CalledProcessError` or `OSError` on failure.
+	"""
+	sp.run(args, shell=False, check=True, **kwargs)
+
+@functools.lru_cache(maxsize=None)
+def terminal_program_exists(programName: str) -> bool:
+	"""Check if `programName` is in PATH. Results are cached per program name.
+	"""
+	return shutil.which(programName) is not None
 
 def find_required_tools(args: ap.Namespace) -> None | str:
 	"""Find the tools required for further processing.
-	If not all required tools are found, an appropriate message for the user is returned.
+	All tools are checked in one pass. If any of them is missing, a single message
+	listing every missing tool is returned.
 	"""
+	requiredTools: list[str] = ['cmake']
+	if not args.not_update_clangd_db:
+		requiredTools.append('compdb')
 
-	# Checking if `cmake` exists with program `command`
-	if not terminal_program_exist('cmake'):
-		return 'Could not locate `cmake`. Aborting...'
+	missing: list[str] = [tool for tool in requiredTools if not terminal_program_exists(tool)]
+	if not missing:
+		return None
 
-	# Checking if `compdb` exists with program `command`
-	if not args.not_update_clangd_db and not terminal_program_exist('compdb'):
-		return '''\
-			Could not locate `compdb`.
-			`compdb` is (in this case) used to update clangd-lsp
-			database for the purpose of bringing better diagnostics \
-		'''
+	message: str = f'Could not locate: {", ".join(f"`{tool}`" for tool in missing)}.'
+	if 'compdb' in missing:
+		message += (
+			'\n`compdb` is (in this case) used to update clangd-lsp'
+			'\ndatabase for the purpose of bringing better diagnostics'
+		)
+	return message + '\nAborting...'
 
 def try_construct_cmake_files(buildDirectory: str, buildType: str) -> None:
 	"""Create target directory for build files and export compile commands for Clangd.
@@ -153,36 +280,159 @@ def try_construct_cmake_files(buildDirectory: str, buildType: str) -> None:
 	"""
 
 	# Create a build directory and enter it
-	sp.run(f'mkdir -p {buildDirectory}', shell=True).check_returncode()
+	os.makedirs(buildDirectory, exist_ok=True)
 	os.chdir(buildDirectory)
 
 	# Generating project using a CMakeLists.txt file
-	sp.run(f'cmake ../CMakeLists.txt -DCMAKE_BUILD_TYPE={buildType.capitalize()} -DCMAKE_EXPORT_COMPILE_COMMANDS=ON -B./',
-			   shell=True
-		   ).check_returncode()
+	run_cmd([
+		'cmake', '../CMakeLists.txt',
+		f'-DCMAKE_BUILD_TYPE={buildType.capitalize()}',
+		'-DCMAKE_EXPORT_COMPILE_COMMANDS=ON',
+		'-B./'
+	])
 
-def compile_database() -> None:
+def compile_database(refresh: bool = False) -> None:
 	"""Use `compdb` to upgrade the `compile_commands.json` file created by CMake.
+	Unless `refresh` is set, `compdb` is skipped if neither CMake's database nor the
+	files in the project directory changed since the last upgrade: the database is
+	then left alone if already upgraded, or the cached `compdb` output is reused.
+	Headers outside the project directory are not tracked, so changes to them
+	need `refresh`. Throws `subprocess.CalledProcessError` or `OSError` on failure.
+	"""
+	source: str = file_digest(COMPILATION_DATABASE)
+	tree: str = source_tree_digest()
+	stamp: None | tuple[str, str, str] = None if refresh else read_database_stamp()
+	if stamp is not None and tree == stamp[1]:
+		if source == stamp[2]:
+			return
+		if source == stamp[0] and cache_is_valid(stamp[2]):
+			publish_database(COMPILATION_DATABASE_CACHE)
+			return
+	
+	# `compdb -p` needs a directory holding a `compile_commands.json`. The directory is
+	# kept between runs and lives in the build directory, so moving the database is a
+	# single rename on the same filesystem.
+	cmakeDatabase: str = os.path.join(COMPDB_DIRECTORY, COMPILATION_DATABASE)
+	os.makedirs(COMPDB_DIRECTORY, exist_ok=True)
+	os.replace(COMPILATION_DATABASE, cmakeDatabase)
+	
+	# `compdb` writes straight to the inherited file descriptor, so buffering on the
+	# Python side would not apply. The database is only read by clangd and can be
+	# regenerated at any time, so it is deliberately never fsync'ed.
+	# The output replaces the cache only once `compdb` succeeded, so a failed run
+	# cannot leave partial output behind for a later run to publish.
+	tmpCache: str = f'{COMPILATION_DATABASE_CACHE}.tmp'
+	try:
+		with open(tmpCache, 'wb') as out:
+			run_cmd(['compdb', '-p', COMPDB_DIRECTORY, 'list'], stdout=out)
+	except (OSError, sp.CalledProcessError):
+		# Drop the partial output and keep CMake's database in place so clangd
+		# still has one to read
+		if os.path.exists(tmpCache):
+			os.remove(tmpCache)
+		os.replace(cmakeDatabase, COMPILATION_DATABASE)
+		raise
+	os.replace(tmpCache, COMPILATION_DATABASE_CACHE)
+	
+	publish_database(COMPILATION_DATABASE_CACHE)
+	write_database_stamp(source, tree, file_digest(COMPILATION_DATABASE_CACHE))
+
+def publish_database(path: str) -> None:
+	"""Replace the database with a copy of the file at `path`.
+	The copy is renamed into place, so readers never see a partially written file.
+	No durability is needed, so neither file is fsync'ed. Throws `OSError` on failure.
 	"""
-	with tempfile.TemporaryDirectory() as tmp_dir:
-		sp.run(f'mv ./compile_commands.json {tmp_dir}/compile_commands.json',
-			shell=True
-		).check_returncode()
-		
-		sp.run(f'compdb -p {tmp_dir} list > "compile_commands.json"',
-			shell=True
-		).check_returncode()
-		
-		sp.run(f'ls {tmp_dir}', shell=True).check_returncode()
-		sp.run(f'rm -r {tmp_dir}', shell=True).check_returncode()
-
-def compile_cmake_project(threadCount: int) -> None:
+	tmpPath: str = f'{COMPILATION_DATABASE}.tmp'
+	shutil.copyfile(path, tmpPath)
+	os.replace(tmpPath, COMPILATION_DATABASE)
+
+def cache_is_valid(digest: str) -> bool:
+	"""Check if the cached `compdb` output exists and matches the recorded `digest`.
+	"""
+	try:
+		return file_digest(COMPILATION_DATABASE_CACHE) == digest
+	except OSError:
+		return False
+
+def file_digest(path: str) -> str:
+	"""Return the SHA-256 hex digest of the file at `path`. Throws `OSError` on failure.
+	"""
+	with open(path, 'rb') as file:
+		return hashlib.sha256(file.read()).hexdigest()
+
+def source_tree_digest() -> str:
+	"""Return a digest of the paths, modification times and sizes of the files in the
+	project directory, skipping hidden directories and the build directory.
+	`compdb` finds header entries through the `#include` lines of the sources, so any
+	change in the tree has to invalidate its cached output.
+	"""
+	buildDirectory: str = os.path.realpath(os.curdir)
+	digest = hashlib.sha256()
+	for root, dirs, files in os.walk(os.pardir):
+		dirs[:] = sorted(
+			name for name in dirs
+			if not name.startswith('.') and os.path.realpath(os.path.join(root, name)) != buildDirectory
+		)
+		for name in sorted(files):
+			path: str = os.path.join(root, name)
+			try:
+				stat: os.stat_result = os.stat(path)
+			except OSError:
+				# Removed in the meantime, or a dangling symlink
+				continue
+			digest.update(f'{path}\0{stat.st_mtime_ns}\0{stat.st_size}\n'.encode())
+	return digest.hexdigest()
+
+def read_database_stamp() -> None | tuple[str, str, str]:
+	"""Return the digests of the CMake database, of the project directory and of the
+	upgraded database recorded by the last `compdb` run, or `None` if there is no valid stamp.
+	"""
+	try:
+		with open(COMPILATION_DATABASE_STAMP, 'r') as stamp:
+			digests: list[str] = stamp.read().split()
+	except OSError:
+		return None
+	if len(digests) != 3:
+		return None
+	return digests[0], digests[1], digests[2]
+
+def write_database_stamp(source: str, tree: str, upgraded: str) -> None:
+	"""Record the digests of the CMake database, of the project directory and of the
+	upgraded database. Throws `OSError` on failure.
+	"""
+	with open(COMPILATION_DATABASE_STAMP, 'w') as stamp:
+		stamp.write(f'{source}\n{tree}\n{upgraded}\n')
+
+def cmake_build_environment(threadCount: None | int) -> dict[str, str]:
+	"""Return the environment compiling a CMake project in parallel with `threadCount` threads.
+	If `threadCount` is `None`, an existing `CMAKE_BUILD_PARALLEL_LEVEL` is
+	respected so outer build systems can schedule jobs globally.
+	The environment of this process is left unchanged.
+	"""
+	if threadCount is None and 'CMAKE_BUILD_PARALLEL_LEVEL' in os.environ:
+		return dict(os.environ)
+	
+	parallelLevel: int = threadCount if threadCount is not None else DEFAULT_THREADS
+	return {**os.environ, 'CMAKE_BUILD_PARALLEL_LEVEL': str(parallelLevel)}
+
+def compile_cmake_project(threadCount: None | int) -> NoReturn:
 	"""Compile a CMake project in parallel with `threadCount` threads.
-	Throws `subprocess.CalledProcessError` on failure.
+	The current process is replaced by `cmake`, so its exit code is returned
+	directly to the caller. Throws `OSError` on failure.
+	"""
+	sys.stdout.flush()
+	sys.stderr.flush()
+	os.execvpe(CMAKE_BUILD_COMMAND[0], CMAKE_BUILD_COMMAND, cmake_build_environment(threadCount))
+
+def compile_cmake_project_with_database(threadCount: None | int, refreshDatabase: bool) -> None:
+	"""Compile a CMake project while `compdb` upgrades the database in a worker thread.
+	`compdb` only needs the database written at configure time, so it does not
+	have to wait for the build. Throws `subprocess.CalledProcessError` or `OSError` on failure.
 	"""
-	sp.run(f'cmake --build ./ --parallel ${threadCount}',
-		shell=True
-	).check_returncode()
+	with ThreadPoolExecutor(max_workers=1) as executor:
+		database: Future[None] = executor.submit(compile_database, refreshDatabase)
+		run_cmd(CMAKE_BUILD_COMMAND, env=cmake_build_environment(threadCount))
+		database.result()
 
 
 if __name__ == "__main__":